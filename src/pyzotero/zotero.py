@@ -23,8 +23,10 @@ import time
 import uuid
 import zipfile
 from collections import OrderedDict
-from functools import wraps
+from email.utils import format_datetime
+from functools import lru_cache, partial, wraps
 from pathlib import Path, PurePosixPath
+from types import MappingProxyType
 from urllib.parse import (
     parse_qs,
     parse_qsl,
@@ -38,16 +40,112 @@ from urllib.parse import (
 import bibtexparser
 import feedparser
 import httpx
-import pytz
 from httpx import Request
 
 import pyzotero as pz
 
+# orjson is optional, and much faster at encoding and decoding JSON
+try:
+    from orjson import dumps as _dumps
+    from orjson import loads as _loads
+except ImportError:
+    _dumps = json.dumps
+    _loads = json.loads
+
+# use HTTP/2 if httpx's optional h2 dependency is installed
+try:
+    import h2  # noqa: F401
+
+    _http2 = True
+except ImportError:
+    _http2 = False
+
 from . import zotero_errors as ze
 
 # Avoid hanging the application if there's no server response
 timeout = 30
 
+# Item fields which are always valid, regardless of what /itemFields returns
+_STATIC_ALLOWED_FIELDS = frozenset(
+    (
+        "path",
+        "tags",
+        "notes",
+        "itemType",
+        "creators",
+        "mimeType",
+        "linkMode",
+        "note",
+        "charset",
+        "dateAdded",
+        "version",
+        "collections",
+        "dateModified",
+        "relations",
+        #  attachment items
+        "parentItem",
+        "mtime",
+        "contentType",
+        "md5",
+        "filename",
+        "inPublications",
+        # annotation fields
+        "annotationText",
+        "annotationColor",
+        "annotationType",
+        "annotationPageLabel",
+        "annotationPosition",
+        "annotationSortIndex",
+        "annotationComment",
+        "annotationAuthorName",
+    )
+)
+
+# The top-level keys of an item which has been retrieved from the API
+_WRAPPED_ITEM_KEYS = frozenset(("links", "library", "version", "meta", "key", "data"))
+
+# the value of the "content" parameter in a request URL
+_CONTENT_PARAM = re.compile(r"(?<=content=)\w+")
+
+# response Content-Type -> format; anything not listed is assumed to be JSON
+_FORMATS = {
+    "application/atom+xml": "atom",
+    "application/x-bibtex": "bibtex",
+    "application/json": "json",
+    "text/html": "snapshot",
+    "text/plain": "plain",
+    "application/pdf; charset=utf-8": "pdf",
+    "application/pdf": "pdf",
+    "application/msword": "doc",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": "pptx",
+    "application/zip": "zip",
+    "application/epub+zip": "zip",
+    "audio/mpeg": "mp3",
+    "video/mp4": "mp4",
+    "audio/x-wav": "wav",
+    "video/x-msvideo": "avi",
+    "application/octet-stream": "octet",
+    "application/x-tex": "tex",
+    "application/x-texinfo": "texinfo",
+    "image/jpeg": "jpeg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "image/tiff": "tiff",
+    "application/postscript": "postscript",
+    "application/rtf": "rtf",
+}
+
+
+@lru_cache(maxsize=None)
+def _ssl_context():
+    """
+    Return a TLS context shared by every client we create: loading the CA
+    bundle is the bulk of the cost of creating an httpx client
+    """
+    return httpx.create_ssl_context()
+
 
 def build_url(base_url, path, args_dict=None):
     """Build a valid URL so we don't have to worry about string concatenation errors and
@@ -84,16 +182,6 @@ def token():
     return str(uuid.uuid4().hex)
 
 
-def cleanwrap(func):
-    """Wrapper for Zotero._cleanup"""
-
-    def enc(self, *args, **kwargs):
-        """Send each item to _cleanup()"""
-        return (func(self, item, **kwargs) for item in args)
-
-    return enc
-
-
 def chunks(iterable, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(iterable), n):
@@ -115,17 +203,14 @@ def tcache(func):
             build_url(self.endpoint, query_string),
             params=params,
         )
-        with httpx.Client() as client:
-            response = client.send(r)
-
-        # now split up the URL
-        result = urlparse(str(response.url))
+        # now split up the URL: there's no need to send the request to do this
+        result = urlparse(str(r.url))
         # construct cache key
         cachekey = f"{result.path}_{result.query}"
         if self.templates.get(cachekey) and not self._updated(
             query_string, self.templates[cachekey], cachekey
         ):
-            return self.templates[cachekey]["tmplt"]
+            return _loads(self.templates[cachekey]["tmplt_json"])
         # otherwise perform a normal request and cache the response
         retrieved = self._retrieve_data(query_string, params=params)
         return self._cache(retrieved, cachekey)
@@ -155,6 +240,7 @@ def backoff_check(func):
         except httpx.HTTPError as exc:
             error_handler(self, resp, exc)
         self.request = resp
+        self._track_version(resp)
         backoff = resp.headers.get("backoff") or resp.headers.get("retry-after")
         if backoff:
             self._set_backoff(backoff)
@@ -185,43 +271,11 @@ def retrieve(func):
         # we now always have links in the header response
         self.links = self._extract_links()
         # determine content and format, based on url params
-        content = (
-            self.content.search(str(self.request.url))
-            and self.content.search(str(self.request.url)).group(0)
-            or "bib"
-        )
-        # JSON by default
-        formats = {
-            "application/atom+xml": "atom",
-            "application/x-bibtex": "bibtex",
-            "application/json": "json",
-            "text/html": "snapshot",
-            "text/plain": "plain",
-            "application/pdf; charset=utf-8": "pdf",
-            "application/pdf": "pdf",
-            "application/msword": "doc",
-            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
-            "application/vnd.openxmlformats-officedocument.presentationml.presentation": "pptx",
-            "application/zip": "zip",
-            "application/epub+zip": "zip",
-            "audio/mpeg": "mp3",
-            "video/mp4": "mp4",
-            "audio/x-wav": "wav",
-            "video/x-msvideo": "avi",
-            "application/octet-stream": "octet",
-            "application/x-tex": "tex",
-            "application/x-texinfo": "texinfo",
-            "image/jpeg": "jpeg",
-            "image/png": "png",
-            "image/gif": "gif",
-            "image/tiff": "tiff",
-            "application/postscript": "postscript",
-            "application/rtf": "rtf",
-        }
+        content = _CONTENT_PARAM.search(str(self.request.url))
+        content = content.group(0) if content else "bib"
         # select format, or assume JSON
         content_type_header = self.request.headers["Content-Type"].lower() + ";"
-        fmt = formats.get(
+        fmt = _FORMATS.get(
             # strip "; charset=..." segment
             content_type_header[0 : content_type_header.index(";")],
             "json",
@@ -245,9 +299,13 @@ def retrieve(func):
         # check to see whether it's tag data
         if "tags" in str(self.request.url):
             self.tag_data = False
-            return self._tags_data(retrieved.json())
+            # keep the library version for delete_tags()
+            self.tags_version = self.request.headers.get("last-modified-version")
+            return self._tags_data(_loads(retrieved.content))
         if fmt == "atom":
-            parsed = feedparser.parse(retrieved.text)
+            # pass a stream: given a string, feedparser first tries to fetch or
+            # open it as a URL or filename, then re-encodes it
+            parsed = feedparser.parse(io.BytesIO(retrieved.content))
             # select the correct processor
             processor = self.processors.get(content)
             # process the content correctly with a custom rule
@@ -265,7 +323,7 @@ def retrieve(func):
             return retrieved.content
         # no need to do anything special, return JSON
         else:
-            return retrieved.json()
+            return _loads(retrieved.content)
 
     return wrapped_f
 
@@ -309,6 +367,8 @@ class Zotero:
             self.library_id = library_id
             # library_type determines whether query begins w. /users or /groups
             self.library_type = library_type + "s"
+            # every library-level API path begins with this
+            self._base_path = f"/{self.library_type}/{self.library_id}"
         else:
             raise ze.MissingCredentials(
                 "Please provide both the library ID and the library type"
@@ -319,14 +379,15 @@ class Zotero:
         self.locale = locale
         self.url_params = None
         self.tag_data = False
+        self.tags_version = None
         self.request = None
         self.snapshot = False
-        self.client = httpx.Client(headers=self.default_headers())
+        self.client = httpx.Client(
+            headers=self.default_headers(), http2=_http2, verify=_ssl_context()
+        )
         # these aren't valid item fields, so never send them to the server
         self.temp_keys = set(["key", "etag", "group_id", "updated"])
         # determine which processor to use for the parsed content
-        self.fmt = re.compile(r"(?<=format=)\w+")
-        self.content = re.compile(r"(?<=content=)\w+")
         self.processors = {
             "bib": self._bib_processor,
             "citation": self._citation_processor,
@@ -422,31 +483,27 @@ class Zotero:
         to self.templates as a new dict using the specified key
         """
         # cache template and retrieval time for subsequent calls
-        try:
-            thetime = datetime.datetime.now(datetime.UTC).replace(
-                tzinfo=pytz.timezone("GMT")
-            )
-        except AttributeError:
-            thetime = thetime = datetime.datetime.utcnow().replace(
-                tzinfo=pytz.timezone("GMT")
-            )
-        self.templates[key] = {"tmplt": response.json(), "updated": thetime}
-        return copy.deepcopy(response.json())
-
-    @cleanwrap
-    def _cleanup(self, to_clean, allow=()):
-        """Remove keys we added for internal use"""
-        # this item's been retrieved from the API, we only need the 'data'
-        # entry
-        if to_clean.keys() == ["links", "library", "version", "meta", "key", "data"]:
-            to_clean = to_clean["data"]
-        return dict(
-            [
-                [k, v]
-                for k, v in list(to_clean.items())
+        thetime = datetime.datetime.now(datetime.timezone.utc)
+        # keep only the raw JSON: each reader decodes its own copy, which is
+        # much cheaper than deepcopy()
+        self.templates[key] = {
+            "tmplt_json": response.content,
+            "updated": thetime,
+        }
+        return _loads(response.content)
+
+    def _cleanup(self, items, allow=()):
+        """Remove keys we added for internal use from each item in items"""
+        for to_clean in items:
+            # this item's been retrieved from the API, we only need the 'data'
+            # entry
+            if to_clean.keys() == _WRAPPED_ITEM_KEYS:
+                to_clean = to_clean["data"]
+            yield {
+                k: v
+                for k, v in to_clean.items()
                 if (k in allow or k not in self.temp_keys)
-            ]
-        )
+            }
 
     def _retrieve_data(self, request=None, params=None):
         """
@@ -497,6 +554,35 @@ class Zotero:
             self._set_backoff(backoff)
         return self.request
 
+    def _send(self, method, path, **kwargs):
+        """
+        Make a request to the API, waiting for any active backoff first
+        Errors are raised, and backoff headers in the response are honoured
+        Returns the response
+        """
+        self._check_backoff()
+        req = self.client.request(method, build_url(self.endpoint, path), **kwargs)
+        self.request = req
+        try:
+            req.raise_for_status()
+        except httpx.HTTPError as exc:
+            error_handler(self, req, exc)
+        if method != "GET":
+            self._track_version(req)
+        backoff = req.headers.get("backoff") or req.headers.get("retry-after")
+        if backoff:
+            self._set_backoff(backoff)
+        return req
+
+    def _track_version(self, resp):
+        """
+        Store the library version returned by a write, for delete_tags()
+        Every successful write bumps the library version, so this keeps
+        tags_version current
+        """
+        if version := resp.headers.get("last-modified-version"):
+            self.tags_version = version
+
     def _extract_links(self):
         """
         Extract self, first, next, last links from a request response
@@ -525,7 +611,7 @@ class Zotero:
 
     def _updated(self, url, payload, template=None):
         """
-        Generic call to see if a template request returns 304
+        Generic call to see if a cached template has been updated on the server
         accepts:
         - a string to combine with the API endpoint
         - a dict of format values, in case they're required by 'url'
@@ -536,33 +622,39 @@ class Zotero:
         # If the template is more than an hour old, try a 304
         if (
             abs(
-                datetime.datetime.utcnow().replace(tzinfo=pytz.timezone("GMT"))
+                datetime.datetime.now(datetime.timezone.utc)
                 - self.templates[template]["updated"]
-            ).seconds
+            ).total_seconds()
             > 3600
         ):
             query = build_url(
                 self.endpoint,
                 url.format(u=self.library_id, t=self.library_type, **payload),
             )
+            # HTTP-dates must be expressed in GMT
             headers = {
-                "If-Modified-Since": payload["updated"].strftime(
-                    "%a, %d %b %Y %H:%M:%S %Z"
-                )
+                "If-Modified-Since": format_datetime(payload["updated"], usegmt=True)
             }
             # perform the request, and check whether the response returns 304
             self._check_backoff()
             req = self.client.get(query, headers=headers)
-            try:
-                req.raise_for_status()
-            except httpx.HTTPError as exc:
-                error_handler(self, req, exc)
-            backoff = self.request.headers.get("backoff") or self.request.headers.get(
-                "retry-after"
-            )
+            # httpx treats 304 as an error status, but here it means "unchanged"
+            if req.status_code != 304:
+                try:
+                    req.raise_for_status()
+                except httpx.HTTPError as exc:
+                    error_handler(self, req, exc)
+            backoff = req.headers.get("backoff") or req.headers.get("retry-after")
             if backoff:
                 self._set_backoff(backoff)
-            return req.status_code == 304
+            # 304 Not Modified: the cached template is still current, so it's
+            # fresh for another hour
+            if req.status_code == 304:
+                self.templates[template]["updated"] = datetime.datetime.now(
+                    datetime.timezone.utc
+                )
+                return False
+            return True
         # Still plenty of life left in't
         return False
 
@@ -593,13 +685,10 @@ class Zotero:
 
     def _build_query(self, query_string, no_params=False):
         """
-        Set request parameters. Will always add the user ID if it hasn't
-        been specifically set by an API method
+        URL-quote a request path, and set the default request parameters
+        if none have been set by an API method
         """
-        try:
-            query = quote(query_string.format(u=self.library_id, t=self.library_type))
-        except KeyError as err:
-            raise ze.ParamNotPassed(f"There's a request parameter missing: {err}")
+        query = quote(query_string)
         # Add the URL parameters and the user key, if necessary
         if no_params is False:
             if not self.url_params:
@@ -613,25 +702,23 @@ class Zotero:
             raise ze.CallDoesNotExist(
                 "This API call does not exist for group libraries"
             )
-        query_string = "/{t}/{u}/publications/items"
+        query_string = f"{self._base_path}/publications/items"
         return self._build_query(query_string)
 
     # The following methods are Zotero Read API calls
     def num_items(self):
         """Return the total number of top-level items in the library"""
-        query = "/{t}/{u}/items/top"
+        query = f"{self._base_path}/items/top"
         return self._totals(query)
 
     def count_items(self):
         """Return the count of all items in a group / library"""
-        query = "/{t}/{u}/items"
+        query = f"{self._base_path}/items"
         return self._totals(query)
 
     def num_collectionitems(self, collection):
         """Return the total number of items in the specified collection"""
-        query = "/{t}/{u}/collections/{c}/items".format(
-            u=self.library_id, t=self.library_type, c=collection.upper()
-        )
+        query = f"{self._base_path}/collections/{collection.upper()}/items"
         return self._totals(query)
 
     def _totals(self, query):
@@ -649,21 +736,19 @@ class Zotero:
         Retrieve info about the permissions associated with the
         key associated to the given Zotero instance
         """
-        query_string = "/keys/{k}".format(k=self.api_key)
+        query_string = f"/keys/{self.api_key}"
         return self._build_query(query_string)
 
     @retrieve
     def items(self, **kwargs):
         """Get user items"""
-        query_string = "/{t}/{u}/items"
+        query_string = f"{self._base_path}/items"
         return self._build_query(query_string)
 
     @retrieve
     def fulltext_item(self, itemkey, **kwargs):
         """Get full-text content for an item"""
-        query_string = "/{t}/{u}/items/{itemkey}/fulltext".format(
-            t=self.library_type, u=self.library_id, itemkey=itemkey
-        )
+        query_string = f"{self._base_path}/items/{itemkey}/fulltext"
         return self._build_query(query_string)
 
     @backoff_check
@@ -681,12 +766,10 @@ class Zotero:
         return self.client.put(
             url=build_url(
                 self.endpoint,
-                "/{t}/{u}/items/{k}/fulltext".format(
-                    t=self.library_type, u=self.library_id, k=itemkey
-                ),
+                f"{self._base_path}/items/{itemkey}/fulltext",
             ),
             headers=headers,
-            data=json.dumps(payload),
+            content=_dumps(payload),
         )
 
     def new_fulltext(self, since):
@@ -694,25 +777,9 @@ class Zotero:
         Retrieve list of full-text content items and versions which are newer
         than <since>
         """
-        query_string = "/{t}/{u}/fulltext".format(
-            t=self.library_type, u=self.library_id
-        )
-        headers = {}
-        params = {"since": since}
-        self._check_backoff()
-        resp = self.client.get(
-            build_url(self.endpoint, query_string), params=params, headers=headers
-        )
-        try:
-            resp.raise_for_status()
-        except httpx.HTTPError as exc:
-            error_handler(self, resp, exc)
-        backoff = self.request.headers.get("backoff") or self.request.headers.get(
-            "retry-after"
-        )
-        if backoff:
-            self._set_backoff(backoff)
-        return resp.json()
+        query_string = f"{self._base_path}/fulltext"
+        resp = self._send("GET", query_string, params={"since": since})
+        return _loads(resp.content)
 
     def item_versions(self, **kwargs):
         """
@@ -744,19 +811,19 @@ class Zotero:
     @retrieve
     def top(self, **kwargs):
         """Get user top-level items"""
-        query_string = "/{t}/{u}/items/top"
+        query_string = f"{self._base_path}/items/top"
         return self._build_query(query_string)
 
     @retrieve
     def trash(self, **kwargs):
         """Get all items in the trash"""
-        query_string = "/{t}/{u}/items/trash"
+        query_string = f"{self._base_path}/items/trash"
         return self._build_query(query_string)
 
     @retrieve
     def searches(self, **kwargs):
         """Get saved searches"""
-        query_string = "/{t}/{u}/searches"
+        query_string = f"{self._base_path}/searches"
         return self._build_query(query_string)
 
     @retrieve
@@ -766,23 +833,19 @@ class Zotero:
             # Currently deleted API doesn't respect limit leaving it out by
             # default preserves compat
             kwargs["limit"] = None
-        query_string = "/{t}/{u}/deleted"
+        query_string = f"{self._base_path}/deleted"
         return self._build_query(query_string)
 
     @retrieve
     def item(self, item, **kwargs):
         """Get a specific item"""
-        query_string = "/{t}/{u}/items/{i}".format(
-            u=self.library_id, t=self.library_type, i=item.upper()
-        )
+        query_string = f"{self._base_path}/items/{item.upper()}"
         return self._build_query(query_string)
 
     @retrieve
     def file(self, item, **kwargs):
         """Get the file from a specific item"""
-        query_string = "/{t}/{u}/items/{i}/file".format(
-            u=self.library_id, t=self.library_type, i=item.upper()
-        )
+        query_string = f"{self._base_path}/items/{item.upper()}/file"
         return self._build_query(query_string, no_params=True)
 
     def dump(self, itemkey, filename=None, path=None):
@@ -805,47 +868,37 @@ class Zotero:
     @retrieve
     def children(self, item, **kwargs):
         """Get a specific item's child items"""
-        query_string = "/{t}/{u}/items/{i}/children".format(
-            u=self.library_id, t=self.library_type, i=item.upper()
-        )
+        query_string = f"{self._base_path}/items/{item.upper()}/children"
         return self._build_query(query_string)
 
     @retrieve
     def collection_items(self, collection, **kwargs):
         """Get a specific collection's items"""
-        query_string = "/{t}/{u}/collections/{c}/items".format(
-            u=self.library_id, t=self.library_type, c=collection.upper()
-        )
+        query_string = f"{self._base_path}/collections/{collection.upper()}/items"
         return self._build_query(query_string)
 
     @retrieve
     def collection_items_top(self, collection, **kwargs):
         """Get a specific collection's top-level items"""
-        query_string = "/{t}/{u}/collections/{c}/items/top".format(
-            u=self.library_id, t=self.library_type, c=collection.upper()
-        )
+        query_string = f"{self._base_path}/collections/{collection.upper()}/items/top"
         return self._build_query(query_string)
 
     @retrieve
     def collection_tags(self, collection, **kwargs):
         """Get a specific collection's tags"""
-        query_string = "/{t}/{u}/collections/{c}/tags".format(
-            u=self.library_id, t=self.library_type, c=collection.upper()
-        )
+        query_string = f"{self._base_path}/collections/{collection.upper()}/tags"
         return self._build_query(query_string)
 
     @retrieve
     def collection(self, collection, **kwargs):
         """Get user collection"""
-        query_string = "/{t}/{u}/collections/{c}".format(
-            u=self.library_id, t=self.library_type, c=collection.upper()
-        )
+        query_string = f"{self._base_path}/collections/{collection.upper()}"
         return self._build_query(query_string)
 
     @retrieve
     def collections(self, **kwargs):
         """Get user collections"""
-        query_string = "/{t}/{u}/collections"
+        query_string = f"{self._base_path}/collections"
         return self._build_query(query_string)
 
     def all_collections(self, collid=None):
@@ -878,36 +931,32 @@ class Zotero:
     @retrieve
     def collections_top(self, **kwargs):
         """Get top-level user collections"""
-        query_string = "/{t}/{u}/collections/top"
+        query_string = f"{self._base_path}/collections/top"
         return self._build_query(query_string)
 
     @retrieve
     def collections_sub(self, collection, **kwargs):
         """Get subcollections for a specific collection"""
-        query_string = "/{t}/{u}/collections/{c}/collections".format(
-            u=self.library_id, t=self.library_type, c=collection.upper()
-        )
+        query_string = f"{self._base_path}/collections/{collection.upper()}/collections"
         return self._build_query(query_string)
 
     @retrieve
     def groups(self, **kwargs):
         """Get user groups"""
-        query_string = "/users/{u}/groups"
+        query_string = f"/users/{self.library_id}/groups"
         return self._build_query(query_string)
 
     @retrieve
     def tags(self, **kwargs):
         """Get tags"""
-        query_string = "/{t}/{u}/tags"
+        query_string = f"{self._base_path}/tags"
         self.tag_data = True
         return self._build_query(query_string)
 
     @retrieve
     def item_tags(self, item, **kwargs):
         """Get tags for a specific item"""
-        query_string = "/{t}/{u}/items/{i}/tags".format(
-            u=self.library_id, t=self.library_type, i=item.upper()
-        )
+        query_string = f"{self._base_path}/items/{item.upper()}/tags"
         self.tag_data = True
         return self._build_query(query_string)
 
@@ -923,6 +972,11 @@ class Zotero:
             return newurl
         return
 
+    @retrieve
+    def _follow_link(self, link):
+        """Return the result of the call to a previously saved 'next' link"""
+        return self._striplocal(link)
+
     def iterfollow(self):
         """Generator for self.follow()"""
         # use same criterion as self.follow()
@@ -934,9 +988,9 @@ class Zotero:
 
     def makeiter(self, func):
         """Return a generator of func's results"""
-        # reset the link. This results in an extra API call, yes
-        self.links["next"] = self.links["self"]
-        return self.iterfollow()
+        # func has already been called, so we already have the first page
+        yield func
+        yield from self.iterfollow()
 
     def everything(self, query):
         """
@@ -944,10 +998,7 @@ class Zotero:
         This method will override the 'limit' parameter if it's been set
         """
         try:
-            items = []
-            items.extend(query)
-            while self.links.get("next"):
-                items.extend(self.follow())
+            items = list(self.iter_everything(query))
         except TypeError:
             # we have a bibliography object ughh
             items = copy.deepcopy(query)
@@ -955,63 +1006,85 @@ class Zotero:
                 items.entries.extend(self.follow().entries)
         return items
 
-    def get_subset(self, subset):
+    def iter_everything(self, query):
+        """
+        Generator version of everything(): yields items one at a time, following
+        the 'next' link only once the current page has been exhausted, so that
+        a single page of results is held in memory at any time
+        """
+        # save the link now: any other call made while the caller is iterating
+        # overwrites self.links
+        return self._iter_pages(query, self.links.get("next"))
+
+    def _iter_pages(self, page, next_link):
+        """Yield the items in page, then those in each page that follows it"""
+        yield from page
+        while next_link:
+            page = self._follow_link(next_link)
+            next_link = self.links.get("next")
+            yield from page
+
+    def get_subset(self, subset, **kwargs):
         """
         Retrieve a subset of items
         Accepts a single argument: a list of item IDs
+        The items are retrieved using a single API call
+        Raises ResourceNotFound if any of the items don't exist
         """
         if len(subset) > 50:
             raise ze.TooManyItems("You may only retrieve 50 items per call")
-        # remember any url parameters that have been set
-        params = self.url_params
-        retr = []
-        for itm in subset:
-            retr.append(self.item(itm))
-            self.url_params = params
-        # clean up URL params when we're finished
-        self.url_params = None
+        if not subset:
+            return []
+        keys = [itm.upper() for itm in subset]
+        # only use the parameters passed to this call: on the /items endpoint,
+        # leftover parameters would act as search filters, or limit the results
+        params = {k: v for k, v in kwargs.items() if k != "start"}
+        params.update(itemKey=",".join(keys), limit=len(keys))
+        retr = self.items(**params)
+        # the API doesn't return items in the order they were requested
+        if isinstance(retr, list) and all(isinstance(itm, dict) for itm in retr):
+            order = {key: pos for pos, key in enumerate(keys)}
+            retr.sort(key=lambda itm: order.get(itm.get("key"), len(keys)))
+            missing = set(keys).difference(itm.get("key") for itm in retr)
+            if missing:
+                raise ze.ResourceNotFound(
+                    f"Items not found: {', '.join(sorted(missing))}"
+                )
         return retr
 
     # The following methods process data returned by Read API calls
+    def _json_loader(self):
+        """Return a callable which decodes a JSON string, preserving key order if required"""
+        if self.preserve_json_order:
+            return partial(json.loads, object_pairs_hook=OrderedDict)
+        return _loads
+
     def _json_processor(self, retrieved):
         """Format and return data from API calls which return Items"""
-        json_kwargs = {}
-        if self.preserve_json_order:
-            json_kwargs["object_pairs_hook"] = OrderedDict
+        loads = self._json_loader()
         # send entries to _tags_data if there's no JSON
         try:
-            items = [
-                json.loads(e["content"][0]["value"], **json_kwargs)
-                for e in retrieved.entries
-            ]
+            items = [loads(e["content"][0]["value"]) for e in retrieved.entries]
         except KeyError:
             return self._tags_data(retrieved)
         return items
 
     def _csljson_processor(self, retrieved):
         """Return a list of dicts which are dumped CSL JSON"""
-        items = []
-        json_kwargs = {}
-        if self.preserve_json_order:
-            json_kwargs["object_pairs_hook"] = OrderedDict
-        for csl in retrieved.entries:
-            items.append(json.loads(csl["content"][0]["value"], **json_kwargs))
+        loads = self._json_loader()
+        items = [loads(csl["content"][0]["value"]) for csl in retrieved.entries]
         self.url_params = None
         return items
 
     def _bib_processor(self, retrieved):
         """Return a list of strings formatted as HTML bibliography entries"""
-        items = []
-        for bib in retrieved.entries:
-            items.append(bib["content"][0]["value"])
+        items = [bib["content"][0]["value"] for bib in retrieved.entries]
         self.url_params = None
         return items
 
     def _citation_processor(self, retrieved):
         """Return a list of strings formatted as HTML citation entries"""
-        items = []
-        for cit in retrieved.entries:
-            items.append(cit["content"][0]["value"])
+        items = [cit["content"][0]["value"] for cit in retrieved.entries]
         self.url_params = None
         return items
 
@@ -1034,7 +1107,7 @@ class Zotero:
         if self.templates.get(template_name) and not self._updated(
             query_string, self.templates[template_name], template_name
         ):
-            return copy.deepcopy(self.templates[template_name]["tmplt"])
+            return _loads(self.templates[template_name]["tmplt_json"])
         # otherwise perform a normal request and cache the response
         retrieved = self._retrieve_data(query_string)
         return self._cache(retrieved, template_name)
@@ -1063,7 +1136,8 @@ class Zotero:
     @ss_wrap
     def show_operators(self):
         """Show available saved search operators"""
-        return self.savedsearch.operators
+        # return a copy: the table itself is read-only, and shared
+        return dict(self.savedsearch.operators)
 
     @ss_wrap
     def show_conditions(self):
@@ -1073,13 +1147,8 @@ class Zotero:
     @ss_wrap
     def show_condition_operators(self, condition):
         """Show available operators for a given saved search condition"""
-        # dict keys of allowed operators for the current condition
-        permitted_operators = self.savedsearch.conditions_operators.get(condition)
-        # transform these into values
-        permitted_operators_list = set(
-            [self.savedsearch.operators.get(op) for op in permitted_operators]
-        )
-        return permitted_operators_list
+        # allowed operators for the current condition
+        return set(self.savedsearch.conditions_operators.get(condition))
 
     @ss_wrap
     def saved_search(self, name, conditions):
@@ -1090,26 +1159,13 @@ class Zotero:
         self.savedsearch._validate(conditions)
         payload = [{"name": name, "conditions": conditions}]
         headers = {"Zotero-Write-Token": token()}
-        self._check_backoff()
-        req = self.client.post(
-            url=build_url(
-                self.endpoint,
-                "/{t}/{u}/searches".format(t=self.library_type, u=self.library_id),
-            ),
+        req = self._send(
+            "POST",
+            f"{self._base_path}/searches",
             headers=headers,
-            data=json.dumps(payload),
+            content=_dumps(payload),
         )
-        self.request = req
-        try:
-            req.raise_for_status()
-        except httpx.HTTPError as exc:
-            error_handler(self, req, exc)
-        backoff = self.request.headers.get("backoff") or self.request.headers.get(
-            "retry-after"
-        )
-        if backoff:
-            self._set_backoff(backoff)
-        return req.json()
+        return _loads(req.content)
 
     @ss_wrap
     def delete_saved_search(self, keys):
@@ -1117,25 +1173,12 @@ class Zotero:
         unique search keys
         """
         headers = {"Zotero-Write-Token": token()}
-        self._check_backoff()
-        req = self.client.delete(
-            url=build_url(
-                self.endpoint,
-                "/{t}/{u}/searches".format(t=self.library_type, u=self.library_id),
-            ),
+        req = self._send(
+            "DELETE",
+            f"{self._base_path}/searches",
             headers=headers,
             params={"searchKey": ",".join(keys)},
         )
-        self.request = req
-        try:
-            req.raise_for_status()
-        except httpx.HTTPError as exc:
-            error_handler(self, req, exc)
-        backoff = self.request.headers.get("backoff") or self.request.headers.get(
-            "retry-after"
-        )
-        if backoff:
-            self._set_backoff(backoff)
         return req.status_code
 
     def upload_attachments(self, attachments, parentid=None, basedir=None):
@@ -1173,60 +1216,25 @@ class Zotero:
             build_url(self.endpoint, query_string),
             params=params,
         )
-        with httpx.Client() as client:
-            response = client.send(r)
         # now split up the URL
-        result = urlparse(str(response.url))
+        result = urlparse(str(r.url))
         # construct cache key
         cachekey = result.path + "_" + result.query
         if self.templates.get(cachekey) and not self._updated(
             query_string, self.templates[cachekey], cachekey
         ):
-            template = set(t["field"] for t in self.templates[cachekey]["tmplt"])
+            template = set(
+                t["field"] for t in _loads(self.templates[cachekey]["tmplt_json"])
+            )
         else:
             template = set(t["field"] for t in self.item_fields())
         # add fields we know to be OK
-        template = template | set(
-            [
-                "path",
-                "tags",
-                "notes",
-                "itemType",
-                "creators",
-                "mimeType",
-                "linkMode",
-                "note",
-                "charset",
-                "dateAdded",
-                "version",
-                "collections",
-                "dateModified",
-                "relations",
-                #  attachment items
-                "parentItem",
-                "mtime",
-                "contentType",
-                "md5",
-                "filename",
-                "inPublications",
-                # annotation fields
-                "annotationText",
-                "annotationColor",
-                "annotationType",
-                "annotationPageLabel",
-                "annotationPosition",
-                "annotationSortIndex",
-                "annotationComment",
-                "annotationAuthorName",
-            ]
-        )
-        template = template | set(self.temp_keys)
+        template = template | _STATIC_ALLOWED_FIELDS | self.temp_keys
         for pos, item in enumerate(items):
-            if set(item) == set(["links", "library", "version", "meta", "key", "data"]):
+            if item.keys() == _WRAPPED_ITEM_KEYS:
                 # we have an item that was retrieved from the API
                 item = item["data"]
-            to_check = set(i for i in list(item.keys()))
-            difference = to_check.difference(template)
+            difference = item.keys() - template
             if difference:
                 raise ze.InvalidItemFields(
                     f"Invalid keys present in item {pos + 1}: {' '.join(i for i in difference)}"
@@ -1292,27 +1300,14 @@ class Zotero:
         headers = {"Zotero-Write-Token": token(), "Content-Type": "application/json"}
         if last_modified is not None:
             headers["If-Unmodified-Since-Version"] = str(last_modified)
-        to_send = json.dumps([i for i in self._cleanup(*payload, allow=("key"))])
-        self._check_backoff()
-        req = self.client.post(
-            url=build_url(
-                self.endpoint,
-                "/{t}/{u}/items".format(t=self.library_type, u=self.library_id),
-            ),
-            data=to_send,
-            headers=dict(headers),
-        )
-        self.request = req
-        try:
-            req.raise_for_status()
-        except httpx.HTTPError as exc:
-            error_handler(self, req, exc)
-        resp = req.json()
-        backoff = self.request.headers.get("backoff") or self.request.headers.get(
-            "retry-after"
+        to_send = _dumps(list(self._cleanup(payload, allow=("key",))))
+        req = self._send(
+            "POST",
+            f"{self._base_path}/items",
+            content=to_send,
+            headers=headers,
         )
-        if backoff:
-            self._set_backoff(backoff)
+        resp = _loads(req.content)
         if parentid:
             # we need to create child items using PATCH
             # TODO: handle possibility of item creation + failed parent
@@ -1320,29 +1315,14 @@ class Zotero:
             uheaders = {
                 "If-Unmodified-Since-Version": req.headers["last-modified-version"]
             }
+            parent_payload = _dumps({"parentItem": parentid})
             for value in resp["success"].values():
-                payload = json.dumps({"parentItem": parentid})
-                self._check_backoff()
-                presp = self.client.patch(
-                    url=build_url(
-                        self.endpoint,
-                        "/{t}/{u}/items/{v}".format(
-                            t=self.library_type, u=self.library_id, v=value
-                        ),
-                    ),
-                    data=payload,
-                    headers=dict(uheaders),
+                self._send(
+                    "PATCH",
+                    f"{self._base_path}/items/{value}",
+                    content=parent_payload,
+                    headers=uheaders,
                 )
-                self.request = presp
-                try:
-                    presp.raise_for_status()
-                except httpx.HTTPError as exc:
-                    error_handler(self, presp, exc)
-                backoff = presp.headers.get("backoff") or presp.headers.get(
-                    "retry-after"
-                )
-                if backoff:
-                    self._set_backoff(backoff)
         return resp
 
     def create_collection(self, payload, last_modified=None):
@@ -1367,24 +1347,13 @@ class Zotero:
         headers = {"Zotero-Write-Token": token()}
         if last_modified is not None:
             headers["If-Unmodified-Since-Version"] = str(last_modified)
-        self._check_backoff()
-        req = self.client.post(
-            url=build_url(
-                self.endpoint,
-                "/{t}/{u}/collections".format(t=self.library_type, u=self.library_id),
-            ),
+        req = self._send(
+            "POST",
+            f"{self._base_path}/collections",
             headers=headers,
-            data=json.dumps(payload),
+            content=_dumps(payload),
         )
-        self.request = req
-        try:
-            req.raise_for_status()
-        except httpx.HTTPError as exc:
-            error_handler(self, req, exc)
-        backoff = req.headers.get("backoff") or req.headers.get("retry-after")
-        if backoff:
-            self._set_backoff(backoff)
-        return req.json()
+        return _loads(req.content)
 
     @backoff_check
     def update_collection(self, payload, last_modified=None):
@@ -1402,14 +1371,27 @@ class Zotero:
         return self.client.put(
             url=build_url(
                 self.endpoint,
-                "/{t}/{u}/collections/{c}".format(
-                    t=self.library_type, u=self.library_id, c=key
-                ),
+                f"{self._base_path}/collections/{key}",
             ),
             headers=headers,
-            data=json.dumps(payload),
+            content=_dumps(payload),
         )
 
+    def _attachment_templates(self, files):
+        """
+        Return a list of imported_file attachment templates, one for each
+        title, file path pair in files. The template is only retrieved once,
+        and each entry is an independent copy of it
+        """
+        orig = _dumps(self._attachment_template("imported_file"))
+        to_add = []
+        for fls in files:
+            tmplt = _loads(orig)
+            tmplt["title"] = fls[0]
+            tmplt["filename"] = fls[1]
+            to_add.append(tmplt)
+        return to_add
+
     def attachment_simple(self, files, parentid=None):
         """
         Add attachments using filenames as title
@@ -1417,15 +1399,8 @@ class Zotero:
         One or more file paths to add as attachments:
         An optional Item ID, which will create child attachments
         """
-        orig = self._attachment_template("imported_file")
-        to_add = [orig.copy() for fls in files]
-        for idx, tmplt in enumerate(to_add):
-            tmplt["title"] = os.path.basename(files[idx])
-            tmplt["filename"] = files[idx]
-        if parentid:
-            return self._attachment(to_add, parentid)
-        else:
-            return self._attachment(to_add)
+        to_add = self._attachment_templates([(os.path.basename(f), f) for f in files])
+        return self._attachment(to_add, parentid)
 
     def attachment_both(self, files, parentid=None):
         """
@@ -1434,15 +1409,8 @@ class Zotero:
         One or more lists or tuples containing title, file path
         An optional Item ID, which will create child attachments
         """
-        orig = self._attachment_template("imported_file")
-        to_add = [orig.copy() for f in files]
-        for idx, tmplt in enumerate(to_add):
-            tmplt["title"] = files[idx][0]
-            tmplt["filename"] = files[idx][1]
-        if parentid:
-            return self._attachment(to_add, parentid)
-        else:
-            return self._attachment(to_add)
+        to_add = self._attachment_templates(files)
+        return self._attachment(to_add, parentid)
 
     @backoff_check
     def update_item(self, payload, last_modified=None):
@@ -1460,12 +1428,10 @@ class Zotero:
         return self.client.patch(
             url=build_url(
                 self.endpoint,
-                "/{t}/{u}/items/{id}".format(
-                    t=self.library_type, u=self.library_id, id=ident
-                ),
+                f"{self._base_path}/items/{ident}",
             ),
             headers=headers,
-            data=json.dumps(to_send),
+            content=_dumps(to_send),
         )
 
     def update_items(self, payload):
@@ -1473,26 +1439,13 @@ class Zotero:
         Update existing items
         Accepts one argument, a list of dicts containing Item data
         """
-        to_send = [self.check_items([p])[0] for p in payload]
+        # check all the items at once: checking fetches the valid item fields
+        to_send = self.check_items(payload)
+        path = f"{self._base_path}/items/"
         # the API only accepts 50 items at a time, so we have to split
         # anything longer
         for chunk in chunks(to_send, 50):
-            self._check_backoff()
-            req = self.client.post(
-                url=build_url(
-                    self.endpoint,
-                    "/{t}/{u}/items/".format(t=self.library_type, u=self.library_id),
-                ),
-                data=json.dumps(chunk),
-            )
-            self.request = req
-            try:
-                req.raise_for_status()
-            except httpx.HTTPError as exc:
-                error_handler(self, req, exc)
-            backoff = req.headers.get("backoff") or req.headers.get("retry-after")
-            if backoff:
-                self._set_backoff(backoff)
+            self._send("POST", path, content=_dumps(chunk))
         return True
 
     def update_collections(self, payload):
@@ -1500,28 +1453,13 @@ class Zotero:
         Update existing collections
         Accepts one argument, a list of dicts containing Collection data
         """
-        to_send = [self.check_items([p])[0] for p in payload]
+        # check all the items at once: checking fetches the valid item fields
+        to_send = self.check_items(payload)
+        path = f"{self._base_path}/collections/"
         # the API only accepts 50 items at a time, so we have to split
         # anything longer
         for chunk in chunks(to_send, 50):
-            self._check_backoff()
-            req = self.client.post(
-                url=build_url(
-                    self.endpoint,
-                    "/{t}/{u}/collections/".format(
-                        t=self.library_type, u=self.library_id
-                    ),
-                ),
-                data=json.dumps(chunk),
-            )
-            self.request = req
-            try:
-                req.raise_for_status()
-            except httpx.HTTPError as exc:
-                error_handler(self, req, exc)
-            backoff = req.headers.get("backoff") or req.headers.get("retry-after")
-            if backoff:
-                self._set_backoff(backoff)
+            self._send("POST", path, content=_dumps(chunk))
         return True
 
     @backoff_check
@@ -1539,11 +1477,9 @@ class Zotero:
         return self.client.patch(
             url=build_url(
                 self.endpoint,
-                "/{t}/{u}/items/{i}".format(
-                    t=self.library_type, u=self.library_id, i=ident
-                ),
+                f"{self._base_path}/items/{ident}",
             ),
-            data=json.dumps({"collections": modified_collections}),
+            content=_dumps({"collections": modified_collections}),
             headers=headers,
         )
 
@@ -1564,15 +1500,12 @@ class Zotero:
         return self.client.patch(
             url=build_url(
                 self.endpoint,
-                "/{t}/{u}/items/{i}".format(
-                    t=self.library_type, u=self.library_id, i=ident
-                ),
+                f"{self._base_path}/items/{ident}",
             ),
-            data=json.dumps({"collections": modified_collections}),
+            content=_dumps({"collections": modified_collections}),
             headers=headers,
         )
 
-    @backoff_check
     def delete_tags(self, *payload):
         """
         Delete a group of tags
@@ -1581,20 +1514,26 @@ class Zotero:
         """
         if len(payload) > 50:
             raise ze.TooManyItems("Only 50 tags or fewer may be deleted")
-        modified_tags = " || ".join([tag for tag in payload])
-        # first, get version data by getting one tag
-        self.tags(limit=1)
-        headers = {
-            "If-Unmodified-Since-Version": self.request.headers["last-modified-version"]
-        }
-        return self.client.delete(
-            url=build_url(
-                self.endpoint,
-                "/{t}/{u}/tags".format(t=self.library_type, u=self.library_id),
-            ),
-            params={"tag": modified_tags},
-            headers=headers,
-        )
+        modified_tags = " || ".join(payload)
+
+        def send():
+            return self._send(
+                "DELETE",
+                f"{self._base_path}/tags",
+                params={"tag": modified_tags},
+                headers={"If-Unmodified-Since-Version": self.tags_version},
+            )
+
+        # we need the library version, so get one tag unless we already have it
+        if self.tags_version is None:
+            self.tags(limit=1)
+        try:
+            send()
+        except ze.PreConditionFailed:
+            # the library has been modified since we got the version
+            self.tags(limit=1)
+            send()
+        return True
 
     @backoff_check
     def delete_item(self, payload, last_modified=None):
@@ -1613,7 +1552,7 @@ class Zotero:
                 modified = payload[0]["version"]
             url = build_url(
                 self.endpoint,
-                "/{t}/{u}/items".format(t=self.library_type, u=self.library_id),
+                f"{self._base_path}/items",
             )
         else:
             ident = payload["key"]
@@ -1623,9 +1562,7 @@ class Zotero:
                 modified = payload["version"]
             url = build_url(
                 self.endpoint,
-                "/{t}/{u}/items/{c}".format(
-                    t=self.library_type, u=self.library_id, c=ident
-                ),
+                f"{self._base_path}/items/{ident}",
             )
         headers = {"If-Unmodified-Since-Version": str(modified)}
         return self.client.delete(url=url, params=params, headers=headers)
@@ -1647,7 +1584,7 @@ class Zotero:
                 modified = payload[0]["version"]
             url = build_url(
                 self.endpoint,
-                "/{t}/{u}/collections".format(t=self.library_type, u=self.library_id),
+                f"{self._base_path}/collections",
             )
         else:
             ident = payload["key"]
@@ -1657,9 +1594,7 @@ class Zotero:
                 modified = payload["version"]
             url = build_url(
                 self.endpoint,
-                "/{t}/{u}/collections/{c}".format(
-                    t=self.library_type, u=self.library_id, c=ident
-                ),
+                f"{self._base_path}/collections/{ident}",
             )
         headers = {"If-Unmodified-Since-Version": str(modified)}
         return self.client.delete(url=url, params=params, headers=headers)
@@ -1711,12 +1646,11 @@ class SavedSearch:
     See https://github.com/zotero/zotero/blob/master/chrome/content/zotero/xpcom/data/searchConditions.js
     """
 
-    def __init__(self, zinstance):
-        super(SavedSearch, self).__init__()
-        self.zinstance = zinstance
-        self.searchkeys = ("condition", "operator", "value")
-        # always exclude these fields from zotero.item_keys()
-        self.excluded_items = (
+    searchkeys = ("condition", "operator", "value")
+    _allowed_keys = frozenset(searchkeys)
+    # always exclude these fields from zotero.item_keys()
+    excluded_items = frozenset(
+        (
             "accessDate",
             "date",
             "pages",
@@ -1724,7 +1658,10 @@ class SavedSearch:
             "seriesNumber",
             "issue",
         )
-        self.operators = {
+    )
+    # read-only, since these tables are shared by every instance
+    operators = MappingProxyType(
+        {
             # this is a bit hacky, but I can't be bothered with Python's enums
             "is": "is",
             "isNot": "isNot",
@@ -1741,132 +1678,129 @@ class SavedSearch:
             "true": "true",
             "false": "false",
         }
-        # common groupings of operators
-        self.groups = {
-            "A": (self.operators["true"], self.operators["false"]),
-            "B": (self.operators["any"], self.operators["all"]),
-            "C": (
-                self.operators["is"],
-                self.operators["isNot"],
-                self.operators["contains"],
-                self.operators["doesNotContain"],
-            ),
-            "D": (self.operators["is"], self.operators["isNot"]),
-            "E": (
-                self.operators["is"],
-                self.operators["isNot"],
-                self.operators["isBefore"],
-                self.operators["isInTheLast"],
-            ),
-            "F": (self.operators["contains"], self.operators["doesNotContain"]),
-            "G": (
-                self.operators["is"],
-                self.operators["isNot"],
-                self.operators["contains"],
-                self.operators["doesNotContain"],
-                self.operators["isLessThan"],
-                self.operators["isGreaterThan"],
-            ),
-            "H": (
-                self.operators["is"],
-                self.operators["isNot"],
-                self.operators["beginsWith"],
+    )
+    _operators_set = frozenset(operators)
+    # common groupings of operators
+    groups = MappingProxyType(
+        {
+            "A": frozenset(("true", "false")),
+            "B": frozenset(("any", "all")),
+            "C": frozenset(("is", "isNot", "contains", "doesNotContain")),
+            "D": frozenset(("is", "isNot")),
+            "E": frozenset(("is", "isNot", "isBefore", "isInTheLast")),
+            "F": frozenset(("contains", "doesNotContain")),
+            "G": frozenset(
+                (
+                    "is",
+                    "isNot",
+                    "contains",
+                    "doesNotContain",
+                    "isLessThan",
+                    "isGreaterThan",
+                )
             ),
-            "I": (self.operators["is"]),
-        }
-        self.conditions_operators = {
-            "deleted": self.groups["A"],
-            "noChildren": self.groups["A"],
-            "unfiled": self.groups["A"],
-            "publications": self.groups["A"],
-            "retracted": self.groups["A"],
-            "includeParentsAndChildren": self.groups["A"],
-            "includeParents": self.groups["A"],
-            "includeChildren": self.groups["A"],
-            "recursive": self.groups["A"],
-            "joinMode": self.groups["B"],
-            "quicksearch-titleCreatorYear": self.groups["C"],
-            "quicksearch-titleCreatorYearNote": self.groups["C"],
-            "quicksearch-fields": self.groups["C"],
-            "quicksearch-everything": self.groups["C"],
-            "collectionID": self.groups["D"],
-            "savedSearchID": self.groups["D"],
-            "collection": self.groups["D"],
-            "savedSearch": self.groups["D"],
-            "dateAdded": self.groups["E"],
-            "dateModified": self.groups["E"],
-            "itemType": self.groups["D"],
-            "fileTypeID": self.groups["D"],
-            "tagID": self.groups["D"],
-            "tag": self.groups["C"],
-            "note": self.groups["F"],
-            "childNote": self.groups["F"],
-            "creator": self.groups["C"],
-            "lastName": self.groups["C"],
-            "field": self.groups["C"],
-            "datefield": self.groups["E"],
-            "year": self.groups["C"],
-            "numberfield": self.groups["G"],
-            "libraryID": self.groups["D"],
-            "key": self.groups["H"],
-            "itemID": self.groups["D"],
-            "annotationText": self.groups["F"],
-            "annotationComment": self.groups["F"],
-            "fulltextWord": self.groups["F"],
-            "fulltextContent": self.groups["F"],
-            "tempTable": self.groups["I"],
+            "H": frozenset(("is", "isNot", "beginsWith")),
+            "I": frozenset(("is",)),
         }
-        ###########
-        # ALIASES #
-        ###########
-        # aliases for numberfield
-        pagefields = (
-            "pages",
-            "numPages",
-            "numberOfVolumes",
-            "section",
-            "seriesNumber",
-            "issue",
+    )
+    _conditions_operators = {
+        "deleted": groups["A"],
+        "noChildren": groups["A"],
+        "unfiled": groups["A"],
+        "publications": groups["A"],
+        "retracted": groups["A"],
+        "includeParentsAndChildren": groups["A"],
+        "includeParents": groups["A"],
+        "includeChildren": groups["A"],
+        "recursive": groups["A"],
+        "joinMode": groups["B"],
+        "quicksearch-titleCreatorYear": groups["C"],
+        "quicksearch-titleCreatorYearNote": groups["C"],
+        "quicksearch-fields": groups["C"],
+        "quicksearch-everything": groups["C"],
+        "collectionID": groups["D"],
+        "savedSearchID": groups["D"],
+        "collection": groups["D"],
+        "savedSearch": groups["D"],
+        "dateAdded": groups["E"],
+        "dateModified": groups["E"],
+        "itemType": groups["D"],
+        "fileTypeID": groups["D"],
+        "tagID": groups["D"],
+        "tag": groups["C"],
+        "note": groups["F"],
+        "childNote": groups["F"],
+        "creator": groups["C"],
+        "lastName": groups["C"],
+        "field": groups["C"],
+        "datefield": groups["E"],
+        "year": groups["C"],
+        "numberfield": groups["G"],
+        "libraryID": groups["D"],
+        "key": groups["H"],
+        "itemID": groups["D"],
+        "annotationText": groups["F"],
+        "annotationComment": groups["F"],
+        "fulltextWord": groups["F"],
+        "fulltextContent": groups["F"],
+        "tempTable": groups["I"],
+    }
+    ###########
+    # ALIASES #
+    ###########
+    # aliases for numberfield
+    _conditions_operators.update(
+        dict.fromkeys(
+            (
+                "pages",
+                "numPages",
+                "numberOfVolumes",
+                "section",
+                "seriesNumber",
+                "issue",
+            ),
+            groups["G"],
         )
-        for pf in pagefields:
-            self.conditions_operators[pf] = self.conditions_operators.get("numberfield")
-        # aliases for datefield
-        datefields = ("accessDate", "date", "dateDue", "accepted")
-        for df in datefields:
-            self.conditions_operators[df] = self.conditions_operators.get("datefield")
-        # aliases for field - this makes a blocking API call unless item types have been cached
-        item_fields = [
-            itm["field"]
+    )
+    # aliases for datefield
+    _conditions_operators.update(
+        dict.fromkeys(("accessDate", "date", "dateDue", "accepted"), groups["E"])
+    )
+
+    def __init__(self, zinstance):
+        super(SavedSearch, self).__init__()
+        self.zinstance = zinstance
+        self.conditions_operators = dict(self._conditions_operators)
+        # aliases for field - this makes a blocking API call unless item fields have been cached
+        field_operators = self._conditions_operators["field"]
+        excluded = self.excluded_items
+        self.conditions_operators.update(
+            (itm["field"], field_operators)
             for itm in self.zinstance.item_fields()
-            if itm["field"] not in set(self.excluded_items)
-        ]
-        for itf in item_fields:
-            self.conditions_operators[itf] = self.conditions_operators.get("field")
+            if itm["field"] not in excluded
+        )
 
     def _validate(self, conditions):
         """Validate saved search conditions, raising an error if any contain invalid operators"""
-        allowed_keys = set(self.searchkeys)
-        operators_set = set(self.operators.keys())
+        allowed_keys = self._allowed_keys
+        operators_set = self._operators_set
+        conditions_operators = self.conditions_operators
         for condition in conditions:
-            if set(condition.keys()) != allowed_keys:
+            if condition.keys() != allowed_keys:
                 raise ze.ParamNotPassed(
                     f"Keys must be all of: {', '.join(self.searchkeys)}"
                 )
-            if condition.get("operator") not in operators_set:
+            operator = condition.get("operator")
+            cond = condition.get("condition")
+            if operator not in operators_set:
                 raise ze.ParamNotPassed(
-                    f"You have specified an unknown operator: {condition.get('operator')}"
+                    f"You have specified an unknown operator: {operator}"
                 )
-            # dict keys of allowed operators for the current condition
-            permitted_operators = self.conditions_operators.get(
-                condition.get("condition")
-            )
-            # transform these into values
-            permitted_operators_list = set(
-                [self.operators.get(op) for op in permitted_operators]
-            )
-            if condition.get("operator") not in permitted_operators_list:
+            # operators which are allowed for the current condition
+            permitted_operators = conditions_operators.get(cond, frozenset())
+            if operator not in permitted_operators:
                 raise ze.ParamNotPassed(
-                    f"You may not use the '{condition.get('operator')}' operator when selecting the '{condition.get('condition')}' condition. \nAllowed operators: {', '.join(list(permitted_operators_list))}"
+                    f"You may not use the '{operator}' operator when selecting the '{cond}' condition. \nAllowed operators: {', '.join(sorted(permitted_operators))}"
                 )
 
 
@@ -1897,19 +1831,14 @@ class Zupload:
         if not payload:  # Check payload has nonzero length
             raise ze.ParamNotPassed
         for templt in payload:
-            if os.path.isfile(str(self.basedir.joinpath(templt["filename"]))):
-                try:
-                    # if it is a file, try to open it, and catch the error
-                    with open(str(self.basedir.joinpath(templt["filename"]))):
-                        pass
-                except IOError:
-                    raise ze.FileDoesNotExist(
-                        f"The file at {str(self.basedir.joinpath(templt['filename']))} couldn't be opened or found."
-                    )
-            # no point in continuing if the file isn't a file
-            else:
+            path = self.basedir.joinpath(templt["filename"])
+            try:
+                # opening a directory raises an error too
+                with open(path, "rb"):
+                    pass
+            except OSError:
                 raise ze.FileDoesNotExist(
-                    f"The file at {str(self.basedir.joinpath(templt['filename']))} couldn't be opened or found."
+                    f"The file at {path} couldn't be opened or found."
                 )
 
     def _create_prelim(self):
@@ -1923,33 +1852,21 @@ class Zupload:
                     "Can't pass payload entries with and without keys to Zupload"
                 )
             return None  # Don't do anything if payload comes with keys
-        liblevel = "/{t}/{u}/items"
+        liblevel = f"{self.zinstance._base_path}/items"
         # Create one or more new attachments
         headers = {"Zotero-Write-Token": token(), "Content-Type": "application/json"}
         # If we have a Parent ID, add it as a parentItem
         if self.parentid:
             for child in self.payload:
                 child["parentItem"] = self.parentid
-        to_send = json.dumps(self.payload)
-        self.zinstance._check_backoff()
-        req = self.zinstance.client.post(
-            url=build_url(
-                self.zinstance.endpoint,
-                liblevel.format(
-                    t=self.zinstance.library_type, u=self.zinstance.library_id
-                ),
-            ),
-            data=to_send,
+        to_send = _dumps(self.payload)
+        req = self.zinstance._send(
+            "POST",
+            liblevel,
+            content=to_send,
             headers=headers,
         )
-        try:
-            req.raise_for_status()
-        except httpx.HTTPError as exc:
-            error_handler(self.zinstance, req, exc)
-        backoff = req.headers.get("backoff") or req.headers.get("retry-after")
-        if backoff:
-            self.zinstance._set_backoff(backoff)
-        data = req.json()
+        data = _loads(req.content)
         for k in data["success"]:
             self.payload[int(k)]["key"] = data["success"][k]
         return data
@@ -1959,10 +1876,16 @@ class Zupload:
         Step 1: get upload authorisation for a file
         """
         mtypes = mimetypes.guess_type(attachment)
-        digest = hashlib.md5()
         with open(attachment, "rb") as att:
-            for chunk in iter(lambda: att.read(8192), b""):
-                digest.update(chunk)
+            # size and mtime come from the open handle, saving two path lookups
+            st = os.fstat(att.fileno())
+            try:
+                digest = hashlib.file_digest(att, "md5")
+            except AttributeError:
+                # hashlib.file_digest() was added in Python 3.11
+                digest = hashlib.md5()
+                for chunk in iter(lambda: att.read(1024 * 1024), b""):
+                    digest.update(chunk)
         auth_headers = {"Content-Type": "application/x-www-form-urlencoded"}
         if not md5:
             auth_headers["If-None-Match"] = "*"
@@ -1972,33 +1895,19 @@ class Zupload:
         data = {
             "md5": digest.hexdigest(),
             "filename": os.path.basename(attachment),
-            "filesize": os.path.getsize(attachment),
-            "mtime": str(int(os.path.getmtime(attachment) * 1000)),
+            "filesize": st.st_size,
+            "mtime": str(int(st.st_mtime * 1000)),
             "contentType": mtypes[0] or "application/octet-stream",
             "charset": mtypes[1],
             "params": 1,
         }
-        self.zinstance._check_backoff()
-        auth_req = self.zinstance.client.post(
-            url=build_url(
-                self.zinstance.endpoint,
-                "/{t}/{u}/items/{i}/file".format(
-                    t=self.zinstance.library_type,
-                    u=self.zinstance.library_id,
-                    i=reg_key,
-                ),
-            ),
+        auth_req = self.zinstance._send(
+            "POST",
+            f"{self.zinstance._base_path}/items/{reg_key}/file",
             data=data,
             headers=auth_headers,
         )
-        try:
-            auth_req.raise_for_status()
-        except httpx.HTTPError as exc:
-            error_handler(self.zinstance, auth_req, exc)
-        backoff = auth_req.headers.get("backoff") or auth_req.headers.get("retry-after")
-        if backoff:
-            self.zinstance._set_backoff(backoff)
-        return auth_req.json()
+        return _loads(auth_req.content)
 
     def _upload_file(self, authdata, attachment, reg_key):
         """
@@ -2008,20 +1917,24 @@ class Zupload:
         reg_key isn't used, but we need to pass it through to Step 3
         """
         upload_dict = authdata["params"]
-        # pass tuple of tuples (not dict!), to ensure key comes first
-        upload_list = [("key", upload_dict.pop("key"))]
-        for key, value in upload_dict.items():
-            upload_list.append((key, value))
-        upload_list.append(("file", open(attachment, "rb").read()))
-        upload_pairs = tuple(upload_list)
+        # the auth params are plain form fields, and the key must come first:
+        # httpx writes data fields in dict order, before the file part
+        # authdata is left unmodified, so that it can be reused
+        form_fields = {"key": upload_dict["key"], **upload_dict}
         try:
             self.zinstance._check_backoff()
-            upload = self.client.post(
-                url=authdata["url"],
-                files=upload_pairs,
-                headers={"User-Agent": f"Pyzotero/{pz.__version__}"},
-            )
-        except httpx.ConnectionError:
+            # pass the open file, so that it's streamed rather than read into memory
+            with open(attachment, "rb") as att:
+                # the upload goes to a third-party URL, so don't send our API key
+                upload = httpx.post(
+                    url=authdata["url"],
+                    data=form_fields,
+                    files={"file": att},
+                    headers={"User-Agent": f"Pyzotero/{pz.__version__}"},
+                    timeout=timeout,
+                    verify=_ssl_context(),
+                )
+        except httpx.ConnectError:
             raise ze.UploadError("ConnectionError")
         try:
             upload.raise_for_status()
@@ -2042,28 +1955,53 @@ class Zupload:
             "If-None-Match": "*",
         }
         reg_data = {"upload": authdata.get("uploadKey")}
-        self.zinstance._check_backoff()
-        upload_reg = self.zinstane.client.post(
-            url=build_url(
-                self.zinstance.endpoint,
-                "/{t}/{u}/items/{i}/file".format(
-                    t=self.zinstance.library_type,
-                    u=self.zinstance.library_id,
-                    i=reg_key,
-                ),
-            ),
-            data=reg_data,
-            headers=dict(reg_headers),
+        url = build_url(
+            self.zinstance.endpoint,
+            f"{self.zinstance._base_path}/items/{reg_key}/file",
         )
+        # the file has already been uploaded, so retry transient failures
+        # rather than making the caller upload it again
+        retries = 3
+        for attempt in range(retries + 1):
+            self.zinstance._check_backoff()
+            upload_reg = self.zinstance.client.post(
+                url=url,
+                data=reg_data,
+                headers=reg_headers,
+            )
+            if upload_reg.status_code != 429 and upload_reg.status_code < 500:
+                break
+            if attempt == retries:
+                raise ze.UploadError(
+                    f"Couldn't register upload of {reg_key} after {retries} retries. "
+                    f"Code: {upload_reg.status_code}"
+                )
+            delay = upload_reg.headers.get("backoff") or upload_reg.headers.get(
+                "retry-after"
+            )
+            self.zinstance._set_backoff(delay if delay is not None else 2**attempt)
         try:
             upload_reg.raise_for_status()
         except httpx.HTTPError as exc:
             error_handler(self.zinstance, upload_reg, exc)
+        self.zinstance._track_version(upload_reg)
         backoff = upload_reg.headers.get("backoff") or upload_reg.headers.get(
             "retry-after"
         )
         if backoff:
-            self._set_backoff(backoff)
+            self.zinstance._set_backoff(backoff)
+
+    def _upload_item(self, item):
+        """
+        Run upload steps 1 - 3 for a single payload entry, returning its status
+        """
+        attach = str(self.basedir.joinpath(item["filename"]))
+        authdata = self._get_auth(attach, item["key"], md5=item.get("md5", None))
+        # no need to keep going if the file exists
+        if authdata.get("exists"):
+            return "unchanged"
+        self._upload_file(authdata, attach, item["key"])
+        return "success"
 
     def upload(self):
         """
@@ -2075,16 +2013,11 @@ class Zupload:
         """
         result = {"success": [], "failure": [], "unchanged": []}
         self._create_prelim()
+        # files are uploaded one at a time: each request updates shared state
+        # (the last request, and the backoff) on the Zotero instance
         for item in self.payload:
             if "key" not in item:
                 result["failure"].append(item)
                 continue
-            attach = str(self.basedir.joinpath(item["filename"]))
-            authdata = self._get_auth(attach, item["key"], md5=item.get("md5", None))
-            # no need to keep going if the file exists
-            if authdata.get("exists"):
-                result["unchanged"].append(item)
-                continue
-            self._upload_file(authdata, attach, item["key"])
-            result["success"].append(item)
+            result[self._upload_item(item)].append(item)
         return result